@@ -1,22 +1,52 @@
+import asyncio
 import logging
 import random
 import time
 
-from multiprocessing import Process, Queue
+from operator import itemgetter
 from connection import Connection
 from query_set import QuerySet
 
+def _take(seq, idx: list[int]) -> tuple:
+    '''
+    Gather the items of `seq` at each of the positions in `idx`.
+    '''
+    if len(idx) == 0:
+        return ()
+    if len(idx) == 1:
+        return (seq[idx[0]],)
+    return itemgetter(*idx)(seq)
+
+async def _gather(query_sets: list[QuerySet]) -> tuple[float, list]:
+    '''
+    Connect every replica's query set, then run them all concurrently.
+
+    :returns total: how long it took for every query set to complete (excluding connecting)
+    :returns results: the (times, plans) returned by each query set
+    '''
+    await asyncio.gather(*[qs.connect() for qs in query_sets])
+
+    tic = time.time()
+    results = await asyncio.gather(*[asyncio.create_task(qs.arun()) for qs in query_sets])
+    toc = time.time()
+
+    return toc - tic, results
+
 class Benchmark:
-    def __init__(self, queries, templates, replicas, routes, config, create_indexes, explain_plans):
+    def __init__(self, queries, templates, n_templates, replicas, routes, config, create_indexes,
+                 explain_plans, prepare_statements=False, pipeline=False, shuffle_seed=None):
         '''
         Benchmarks the performance of created indexes by finding the execution
         time of every query in the workload. Reports the total execution time
         as well as the execution time for each query.
+
+        The order each replica runs its queries in is shuffled on every run.
+        If a `shuffle_seed` is given, the sequence of orders is reproducible.
         '''
         self.queries = queries
         self.templates = templates
         self.n_queries = len(queries)
-        self.n_templates = len(list(set(templates)))
+        self.n_templates = n_templates
         self.replicas = replicas
         self.connections = [Connection(r) for r in replicas]
         self.cursors = [c.conn().cursor() for c in self.connections]
@@ -24,28 +54,73 @@ class Benchmark:
         self.config = config
         self.times = [0 for _ in range(self.n_templates)]
         self.plans = ['' for _ in range(self.n_templates)]
-        self.order = [i for i in range(self.n_queries)]
+        self._per_replica_idx = self._split_workload()
+        self._rng = random.Random(shuffle_seed)
         self.explain_plans = explain_plans
+        self.prepare_statements = prepare_statements
+        self.pipeline = pipeline
+        self._ddl_cache = None
 
         if create_indexes:
             self._create_indexes()
         else:
             logging.warning('skipping index creation!')
     
-    def _create_indexes(self):
+    def _split_workload(self) -> list[list[int]]:
         '''
-        Create the indexes in the index configuration that the recommendation
-        program (qDINA) created.
+        Work out which queries each replica is responsible for, according
+        to the routing table. Queries routed to -1 are sent to every replica.
+
+        :returns: the indexes of the queries to run on each replica
         '''
-        logging.info('creating indexes!')
+        per_replica_idx = [[] for _ in self.replicas]
+
+        for query_num, template in enumerate(self.templates):
+            replica = self.routes[template]
+            if replica == -1:
+                for idx in per_replica_idx:
+                    idx.append(query_num)
+            else:
+                per_replica_idx[replica].append(query_num)
 
+        return per_replica_idx
+
+    def _index_ddl(self) -> list[tuple[str, str]]:
+        '''
+        Build (and cache) the DDL to create and drop each replica's indexes.
+        Each replica's statements are joined into one string so they can be
+        sent in a single round trip.
+
+        :returns: a (create, drop) pair of SQL strings for each replica
+        '''
+        if self._ddl_cache is not None:
+            return self._ddl_cache
+
+        self._ddl_cache = []
         indexes_created = 0
 
-        for i_rep, config in enumerate(self.config):
-            cur = self.cursors[i_rep]
+        for config in self.config:
+            create = []
+            drop = []
             for index in config:
                 indexes_created += 1
-                cur.execute(f'CREATE INDEX idx_{indexes_created} ON {index[0]} ({','.join(index[1])})')
+                create.append(f'CREATE INDEX idx_{indexes_created} ON {index[0]} ({','.join(index[1])})')
+                drop.append(f'DROP INDEX idx_{indexes_created}')
+            self._ddl_cache.append((';\n'.join(create), ';\n'.join(drop)))
+
+        return self._ddl_cache
+
+    def _create_indexes(self):
+        '''
+        Create the indexes in the index configuration that the recommendation
+        program (qDINA) created.
+        '''
+        logging.info('creating indexes!')
+
+        # a multi-statement string runs as a single implicit transaction
+        for i_rep, (create, _) in enumerate(self._index_ddl()):
+            if create:
+                self.cursors[i_rep].execute(create)
     
     def run(self) -> tuple[float, list[float]]:
         '''
@@ -54,59 +129,37 @@ class Benchmark:
         :returns total: the overall query execution time
         :returns times: how long each query took to execute, in workload (not shuffled) order
         '''
-        random.shuffle(self.order)
-
-        replica_workloads = [[] for _ in self.replicas]
-        replica_templates = [[] for _ in self.replicas]
+        replica_workloads = []
+        replica_templates = []
 
-        for query_num in self.order:
-            query = self.queries[query_num]
-            template = self.templates[query_num]
-            replica = self.routes[template]
-
-            if replica == -1:
-                for i in range(len(self.replicas)):
-                    replica_workloads[i].append(query)
-                    replica_templates[i].append(template)
-            else:
-                replica_workloads[replica].append(query)
-                replica_templates[replica].append(template)
+        for idx in self._per_replica_idx:
+            self._rng.shuffle(idx)
+            replica_workloads.append(_take(self.queries, idx))
+            replica_templates.append(_take(self.templates, idx))
         
         query_sets = []
-        timer_queues = [Queue() for _ in self.replicas]
 
         for i, replica in enumerate(self.replicas):
-            query_sets.append(QuerySet(i, replica_workloads[i], replica_templates[i], replica, timer_queues[i], self.explain_plans))
-        
-        processes = [Process(target=qs.run) for qs in query_sets]
+            query_sets.append(QuerySet(i, replica_workloads[i], replica_templates[i], replica, self.explain_plans, self.prepare_statements, self.pipeline))
 
-        tic = time.time()
-        [p.start() for p in processes]
-        [p.join() for p in processes]
-        toc = time.time()
+        total, results = asyncio.run(_gather(query_sets))
 
-        for replica, queue in enumerate(timer_queues):
-            info = queue.get()
-            for i, q_time in enumerate(info['times']):
+        for replica, (times, plans) in enumerate(results):
+            for i, q_time in enumerate(times):
                 template = replica_templates[replica][i]
-                self.times[template] += q_time
+                self.times[template] += q_time / 1e9
             if self.explain_plans:
-                for i, plan in enumerate(info['plans']):
+                for i, plan in enumerate(plans):
                     template = replica_templates[replica][i]
                     self.plans[template] = plan
     
-        total = toc - tic
-        logging.debug(f'all queries completed in {round(total, 2)}s')
+        logging.debug('all queries completed in %.2fs', total)
 
         return total, self.times, self.plans
     
     def destroy_indexes(self):
-        indexes_destroyed = 0
-
-        for i_rep, config in enumerate(self.config):
-            cur = self.cursors[i_rep]
-            for index in config:
-                indexes_destroyed += 1
-                cur.execute(f'DROP INDEX idx_{indexes_destroyed}')
+        for i_rep, (_, drop) in enumerate(self._index_ddl()):
+            if drop:
+                self.cursors[i_rep].execute(drop)
         
         logging.debug('dropped indexes')
@@ -34,3 +34,30 @@ class Connection:
         if self._connection is not None:
             self._connection.close()
             self._connection = None
+
+class AsyncConnection:
+    def __init__(self, replica: Replica):
+        '''
+        Represents a single asynchronous connection to a database, for use
+        with asyncio. Unlike `Connection`, the connection isn't opened until
+        `connect` is awaited, so that it is created inside the running event loop.
+
+        :param replica: the database `Replica` we are connecting to
+        '''
+        self.replica = replica
+        self._connection = None
+    
+    async def connect(self):
+        self._connection = await psycopg.AsyncConnection.connect(self.replica.connection_string, autocommit=True)
+    
+    def conn(self):
+        if self._connection is not None:
+            return self._connection
+        
+        logging.error(f'connecting to replica {self.replica.id}: connection is not open!')
+        return None
+    
+    async def close(self):
+        if self._connection is not None:
+            await self._connection.close()
+            self._connection = None
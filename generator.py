@@ -1,4 +1,109 @@
+import logging
+import os
+import queue
+import re
+import shutil
+
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from psycopg.copy import QueuedLibpqWriter
+from connection import Connection
+from replica import Replica
+
+TABLE_BLOCK_SIZE = 16 * 1024 * 1024
+# the maintenance_work_mem (in MB) the key builds on a replica may use between them
+MAINTENANCE_WORK_MEM_MB = 2048
+# how many keys are built at once on each replica, by default
+KEY_WORKERS = 4
+
+_COMMENT_RE = re.compile(r'--[^\n]*')
+_ALTER_TABLE_RE = re.compile(r'alter\s+table\s+(\w+)', re.IGNORECASE)
+_PRIMARY_KEY_RE = re.compile(r'primary\s+key', re.IGNORECASE)
+_CREATE_TABLE_RE = re.compile(r'\bcreate\s+table\b', re.IGNORECASE)
+
+def list_tables(directory: str, extension: str) -> list[tuple[str, str]]:
+    '''
+    Finds the table data files in a directory, named after their tables.
+
+    :param directory: the directory to search
+    :param extension: the extension of the table files (eg .tbl)
+    :returns: the table name and path of each table file, sorted by name
+    '''
+    with os.scandir(directory) as entries:
+        return sorted((entry.name[:-len(extension)], entry.path) for entry in entries if entry.name.endswith(extension))
+
+def unlogged_ddl(ddl: str) -> str:
+    '''
+    Rewrites a schema so that its tables are created UNLOGGED. Unlogged tables
+    are not written to the WAL, so are faster to load and build keys on, but
+    are emptied if the server crashes and are not replicated.
+
+    :param ddl: the schema
+    :returns: the schema, with every CREATE TABLE made CREATE UNLOGGED TABLE
+    '''
+    return _CREATE_TABLE_RE.sub('CREATE UNLOGGED TABLE', ddl)
+
+def split_key_statements(script: str) -> tuple[list[list[str]], list[str]]:
+    '''
+    Splits a script of ALTER TABLE statements adding the primary and foreign
+    keys into the primary keys, grouped by the table they are on, and the
+    foreign keys.
+
+    A primary key only locks its own table, so the groups can be built
+    concurrently. A foreign key also takes a self-conflicting lock on the
+    table it references, and nearly every one references a shared table
+    (eg orders, or date_dim in TPC-DS), so they would only queue behind
+    each other; they are run one after another instead.
+
+    :param script: the key creation script (eg schema_keys.sql)
+    :returns primary_keys: the groups of primary keys
+    :returns foreign_keys: the foreign keys, to be run once every primary key exists
+    '''
+    primary_keys = {}
+    foreign_keys = []
+
+    for statement in _COMMENT_RE.sub('', script).split(';'):
+        statement = statement.strip()
+        if not statement:
+            continue
+        if not _PRIMARY_KEY_RE.search(statement):
+            foreign_keys.append(statement)
+            continue
+        match = _ALTER_TABLE_RE.match(statement)
+        table = match.group(1).lower() if match else statement
+        primary_keys.setdefault(table, []).append(statement)
+
+    return list(primary_keys.values()), foreign_keys
+
+@contextmanager
+def open_sequential(path: str):
+    '''
+    Open a file in unbuffered binary mode for a single sequential read,
+    advising the kernel (where supported) to read ahead aggressively.
+
+    The pages are deliberately not dropped from the page cache afterwards:
+    every replica is loaded from the same files at the same time, so one
+    replica's reads warm the cache for the others.
+
+    :param path: the file to open
+    '''
+    with os.fdopen(os.open(path, os.O_RDONLY), 'rb', buffering=0) as infile:
+        if hasattr(os, 'posix_fadvise'):
+            try:
+                os.posix_fadvise(infile.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            except OSError:
+                # it's only a hint, and some filesystems reject it
+                pass
+        yield infile
+
 class Generator:
+    # the extension of the table data files written by the generator
+    table_extension = None
+    # the format options the table data files are loaded with by COPY
+    copy_options = None
+    # how many query templates the benchmark has
+    n_templates = None
+
     def __init__(self):
         pass
 
@@ -11,15 +116,202 @@ class Generator:
     
     def load_database(self):
         '''
-        Load the database with the generated table data.
+        Loads the data into the database.
+
+        (1) Resets each database, creates the schemas, and loads the generated table data.
+
+        (2) Creates the default primary key/foreign key constraints on those tables.
         '''
-        raise NotImplementedError
+        connections = [Connection(replica) for replica in self.replicas]
+        tables = self._tables()
+
+        self._reset_database(connections, tables)
+        self._create_schemas(connections)
+        self._load_table_data(connections)
+        self._create_keys(connections)
 
-    def read_data(self) -> list[str]:
+        for c in connections:
+            c.close()
+
+    def read_data(self) -> tuple[list[str], list[int], int]:
         '''
         Reads the generated query data into memory and returns it
         as a list of strings.
 
-        :returns: the generated queries
+        :returns queries: the generated queries
+        :returns templates: the template number of each query
+        :returns n_templates: how many templates there are
         '''
         raise NotImplementedError
+
+    def _foreach_conn(self, connections: list, fn):
+        '''
+        Call `fn` on every connection concurrently, one thread per connection,
+        since each is to an independent replica. Waits for every call to
+        finish, and raises the first exception encountered, if any.
+
+        :param connections: the `Connection`s to the replicas
+        :param fn: a function taking a single `Connection`
+        '''
+        with ThreadPoolExecutor(max_workers=len(connections)) as executor:
+            futures = [executor.submit(fn, c) for c in connections]
+            for future in futures:
+                future.result()
+
+    def _tables(self) -> list[str]:
+        '''
+        :returns: the names of the tables that will be loaded
+        '''
+        return [table for table, _ in list_tables(f'{self.data_path}/tables', self.table_extension)]
+
+    def _reset_database(self, connections: list[Connection], tables: list[str]):
+        '''
+        Drops the tables specified.
+
+        :param tables: a list of table names
+        '''
+        logging.debug(f'dropping existing tables: {tables}')
+
+        def drop(c: Connection):
+            with c.conn().cursor() as cur:
+                for table in tables:
+                    cur.execute(f'DROP TABLE IF EXISTS {table} CASCADE')
+
+        self._foreach_conn(connections, drop)
+
+    def _create_schemas(self, connections: list[Connection]):
+        logging.info('creating the schemas for tables')
+        with open(f'{self.data_path}/schema/dss.ddl', 'r') as infile:
+            ddl = infile.read()
+        if self.unlogged_tables:
+            ddl = unlogged_ddl(ddl)
+
+        def create(c: Connection):
+            with c.conn().cursor() as cur:
+                cur.execute(ddl)
+
+        self._foreach_conn(connections, create)
+
+    def _create_keys(self, connections: list[Connection]):
+        logging.info('creating primary and foreign keys')
+        with open(f'{self.data_path}/schema/schema_keys.sql', 'r') as infile:
+            primary_keys, foreign_keys = split_key_statements(infile.read())
+
+        # the foreign keys need the primary keys they reference to exist. they
+        # are validated over the replica's own connection, one at a time
+        def create(c: Connection):
+            self._execute_groups(c.replica, primary_keys)
+            with c.conn().cursor() as cur:
+                for statement in foreign_keys:
+                    cur.execute(statement)
+
+        self._foreach_conn(connections, create)
+
+    def _load_table_data(self, connections: list[Connection]):
+        '''
+        Loads the table data into every replica concurrently. Each replica
+        is an independent server, so each gets its own worker thread that
+        loads the tables one after another over that replica's connection.
+        '''
+        table_files = list_tables(f'{self.data_path}/tables', self.table_extension)
+
+        self._foreach_conn(connections, lambda c: self._load_replica(c, table_files))
+
+    def _load_replica(self, connection: Connection, table_files: list[tuple[str, str]]):
+        self._prepare_load_session(connection)
+        for table, table_file in table_files:
+            logging.info(f'loading data into {table} on replica {connection.replica.id}')
+            with open_sequential(table_file) as input, self._copy_into(connection, table) as copy:
+                self._write_table(copy, input)
+
+    @contextmanager
+    def _copy_into(self, connection: Connection, table: str):
+        '''
+        Starts a COPY into a table. If the block raises, the COPY is aborted.
+
+        :param connection: the connection to the replica
+        :param table: the table to load
+        '''
+        with connection.conn().cursor() as cur:
+            # the queued writer sends each block from a worker thread while the next is read
+            with cur.copy(f'COPY {table} FROM STDIN {self.copy_options}',
+                          writer=QueuedLibpqWriter(cur)) as copy:
+                yield copy
+
+    def _write_table(self, copy, input):
+        '''
+        Writes the table data to a COPY. Subclasses override this should the
+        data need correcting on the way.
+
+        :param copy: the COPY, from `_copy_into`
+        :param input: the table data, in binary mode
+        '''
+        shutil.copyfileobj(input, copy, length=TABLE_BLOCK_SIZE)
+
+    def _load_queries(self) -> tuple[list[str], list[int], int]:
+        # the query files don't change once generated, so only read them once
+        if self._queries is not None:
+            return self._queries
+
+        logging.info('reading queries')
+        queries = []
+        templates = list(range(self.n_templates))
+
+        for i in range(1, self.n_templates + 1):
+            with open(f'{self.data_path}/queries/{i}.sql', 'r') as infile:
+                queries.append(infile.read())
+        
+        self._queries = queries, templates, len(templates)
+        return self._queries
+
+    def _prepare_load_session(self, connection: Connection):
+        '''
+        Stops a connection waiting for the WAL to be flushed to disk whenever it
+        commits, for the duration of the load. A crash could lose the last few
+        tables committed, but they would be reloaded from scratch anyway.
+
+        :param connection: the connection the tables will be loaded over
+        '''
+        with connection.conn().cursor() as cur:
+            cur.execute('SET synchronous_commit TO off')
+
+    def _execute_groups(self, replica: Replica, groups: list[list[str]]):
+        '''
+        Runs groups of key building statements on a replica over up to
+        `key_workers` connections of its own, so that the server can work on
+        several at once. Each connection takes the next group waiting when it
+        finishes one, and runs its statements in order.
+
+        The connections share `MAINTENANCE_WORK_MEM_MB` equally, so the memory
+        the builds use on the server doesn't grow with the number of workers.
+
+        :param replica: the database to run the statements on
+        :param groups: the groups of statements
+        '''
+        if not groups:
+            return
+
+        n_workers = max(1, min(self.key_workers, len(groups)))
+        work_mem = f"SET maintenance_work_mem = '{MAINTENANCE_WORK_MEM_MB // n_workers}MB'"
+
+        pending = queue.SimpleQueue()
+        for group in groups:
+            pending.put(group)
+
+        def work(c: Connection):
+            with c.conn().cursor() as cur:
+                cur.execute(work_mem)
+                while True:
+                    try:
+                        group = pending.get_nowait()
+                    except queue.Empty:
+                        return
+                    for statement in group:
+                        cur.execute(statement)
+
+        workers = [Connection(replica) for _ in range(n_workers)]
+        try:
+            self._foreach_conn(workers, work)
+        finally:
+            for c in workers:
+                c.close()
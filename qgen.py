@@ -1,10 +1,15 @@
 import logging
-import subprocess
 import os
 import glob
 import shutil
 import random
 import argparse
+import json
+
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from tools import make_argv, run_checked
+from query_loader import QUERY_SET_FILE, clean_query_text
 
 ROOT_DIR = os.path.dirname(os.path.realpath(__file__))
 DBGEN_DIR = os.path.join(ROOT_DIR, './tpc-h/dbgen')
@@ -22,7 +27,7 @@ def get_arguments():
 
 def _compile_dbgen():
     logging.debug(f'attempting to compile TPC-H dbgen at {DBGEN_DIR}')
-    subprocess.run('make', cwd=DBGEN_DIR)
+    logging.debug(run_checked(make_argv(), DBGEN_DIR))
 
 def _move_query_templates():
     existing_templates = glob.glob(f'{DBGEN_DIR}/queries/*.sql')
@@ -34,19 +39,44 @@ def _move_query_templates():
     for template in corrected_templates:
         shutil.copy(template, f'{DBGEN_DIR}/queries')
 
+def _run_qgen(i, j, scale_factor, seed, dbgen_dir):
+    '''
+    Generate a single query from template `i` with the given seed.
+
+    :returns: the template, query number, and cleaned query text
+    '''
+    sql = run_checked([f'{dbgen_dir}/qgen', '-s', str(scale_factor), '-r', str(seed), str(i)],
+                      dbgen_dir,
+                      dict(os.environ, DSS_QUERY=f'{dbgen_dir}/queries'))
+
+    return i, j, clean_query_text(sql)
+
 def _create_queries(outpath, num_per_template, scale_factor):
+    '''
+    Generate the query set and write it to a single JSON lines file in
+    `outpath`, one query per line. The file is written to a temporary
+    location and renamed into place once every query has been generated,
+    so an interrupted run never leaves a partial query set behind.
+    '''
     logging.debug(f'* creating TPC-H query data')
 
-    for i in range(1, 23):
-        logging.debug(f'+ {i} / 22')
-        for j in range(num_per_template):
-            if j % 10 == 0:
-                logging.debug(f'-   {j}')
-            with open(f'{outpath}/{i}_{j}.sql', 'w') as outfile:
-                subprocess.run([f'{DBGEN_DIR}/qgen', '-s', str(scale_factor), '-r', str(RNG_SEED + j), str(i)],
-                                cwd=DBGEN_DIR,
-                                env=dict(os.environ, DSS_QUERY=f'{DBGEN_DIR}/queries'),
-                                stdout=outfile)
+    jobs = [(i, j) for i in range(1, 23) for j in range(num_per_template)]
+    final_path = f'{outpath}/{QUERY_SET_FILE}'
+    tmp_path = f'{outpath}/.{QUERY_SET_FILE}.tmp'
+
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor, open(tmp_path, 'w') as outfile:
+        results = executor.map(_run_qgen,
+                               [i for i, _ in jobs],
+                               [j for _, j in jobs],
+                               repeat(scale_factor),
+                               [RNG_SEED + j for _, j in jobs],
+                               repeat(DBGEN_DIR))
+        for i, j, sql in results:
+            outfile.write(json.dumps({'template': i, 'query': j, 'sql': sql}) + '\n')
+            if j == num_per_template - 1:
+                logging.debug(f'+ {i} / 22')
+
+    os.replace(tmp_path, final_path)
 
 if __name__ == '__main__':
     logging.getLogger().setLevel(logging.DEBUG)
@@ -1,38 +1,88 @@
-import glob
+import json
 import os
 import re
 
-def load_test_set_queries(path: str) -> tuple[list[str], list[int]]:
+from array import array
+
+QUERY_SET_FILE = 'queries.jsonl'
+
+_WHITESPACE_TABLE = str.maketrans('\n\t', '  ')
+_SUBQUERY_RE = re.compile(r'(?:from|,)[ \n]*\(', re.IGNORECASE)
+_PAREN_RE = re.compile(r'[()]')
+_NEXT_WORD_RE = re.compile(r'\s*([^ \n]*)')
+_ALIAS_TRIGGERS = {'limit', 'group', 'order', 'where'}
+_DAYS_RE = re.compile(r" ([0-9]+) days\)")
+# both of hyrise's limit fixes in one pass: the longest alternative comes
+# first so that ';\nlimit -1' is rewritten as though each fix ran in turn
+_LIMIT_RE = re.compile(r";\nlimit -1|;\nlimit |limit -1")
+_LIMIT_REPLACEMENTS = {';\nlimit -1': ' ', ';\nlimit ': ' limit ', 'limit -1': ''}
+
+def load_test_set_queries(path: str) -> tuple[list[str], array, int]:
     '''
     Load the pregenerated queries in the training set located at `path`.
     Returns the query text in a list as well as which template each query belongs to.
+
+    If the directory contains a `queries.jsonl` file (as written by qgen.py),
+    the already-cleaned queries are read from it directly. Otherwise, each
+    query is read from its own `{template}_{query number}.sql` file.
+
+    :returns queries: the text of each query
+    :returns templates: the (zero-indexed) template number of each query
+    :returns n_templates: the number of templates, ie one more than the highest template number
     '''
-    # first: how many templates are there, and how many queries do each one of them have?
-    all_queries = glob.glob(f'{path}/*.sql')
-    query_names = [os.path.basename(q) for q in all_queries]
-    name_parts = [q.split('_') for q in query_names]
-    template_strs = list(set([t[0] for t in name_parts]))
-    query_nums = list(set([int(q[1].strip('.sql')) for q in name_parts]))
+    if os.path.isfile(f'{path}/{QUERY_SET_FILE}'):
+        return _load_query_set_file(f'{path}/{QUERY_SET_FILE}')
+
+    # each query is named {template}_{query number}.sql
+    with os.scandir(path) as entries:
+        query_names = [e.name for e in entries if e.name.endswith('.sql')]
+    name_parts = [q[:-len('.sql')].split('_') for q in query_names]
+    query_ids = sorted((int(t[0]), int(t[1])) for t in name_parts)
 
     queries = []
-    templates = []
-
-    for i, template in enumerate(template_strs):
-        for query_num in query_nums:
-            try:
-                with open(f'{path}/{template}_{query_num}.sql', 'r') as infile:
-                    lines = infile.readlines()
-            except:
-                continue
-            if lines[0].startswith('--'):
-                lines = lines[1:]
-            query = ' '.join(lines)
-            query = query.replace('\n', ' ').replace('\t', ' ')
-            query = update_query_text(query)
-            queries.append(query)
-            templates.append(int(template) - 1)
+    templates = array('i')
+
+    for template, query_num in query_ids:
+        with open(f'{path}/{template}_{query_num}.sql', 'rb') as infile:
+            query = infile.read().decode()
+        queries.append(clean_query_text(query))
+        templates.append(template - 1)
     
-    return queries, templates
+    n_templates = query_ids[-1][0] if query_ids else 0
+
+    return queries, templates, n_templates
+
+def _load_query_set_file(path: str) -> tuple[list[str], array, int]:
+    '''
+    Load the queries from a JSON lines query set file, one
+    `{"template": ..., "query": ..., "sql": ...}` object per line.
+    '''
+    queries = []
+    templates = array('i')
+
+    with open(path, 'r') as infile:
+        for line in infile:
+            entry = json.loads(line)
+            queries.append(entry['sql'])
+            templates.append(entry['template'] - 1)
+
+    n_templates = max(templates) + 1 if templates else 0
+
+    return queries, templates, n_templates
+
+def clean_query_text(text: str) -> str:
+    '''
+    Prepares the raw output of qgen for execution: removes the leading
+    seed comment, flattens the query onto one line, and applies
+    `update_query_text`.
+
+    :param text: the query as generated by qgen
+    :returns text: the cleaned query
+    '''
+    if text.startswith('--'):
+        text = text[text.find('\n') + 1:]
+    text = text.translate(_WHITESPACE_TABLE)
+    return update_query_text(text)
 
 def update_query_text(text: str) -> str:
     '''
@@ -43,33 +93,33 @@ def update_query_text(text: str) -> str:
     :param text: the text of the query to update
     :returns text: the corrected version
     '''
-    text = text.replace(";\nlimit ", " limit ").replace("limit -1", "")
-    text = re.sub(r" ([0-9]+) days\)", r" interval '\1 days')", text)
+    text = _LIMIT_RE.sub(lambda m: _LIMIT_REPLACEMENTS[m.group()], text)
+    text = _DAYS_RE.sub(r" interval '\1 days')", text)
     text = add_alias_subquery(text)
     return text
 
 # PostgreSQL requires an alias for subqueries
 def add_alias_subquery(query_text):
-    text = query_text.lower()
     positions = []
-    for match in re.finditer(r"((from)|,)[  \n]*\(", text):
-        counter = 1
-        pos = match.span()[1]
-        while counter > 0:
-            char = text[pos]
-            if char == "(":
-                counter += 1
-            elif char == ")":
-                counter -= 1
-            pos += 1
-        next_word = query_text[pos:].lstrip().split(" ")[0].split("\n")[0]
-        if next_word[0] in [")", ","] or next_word in [
-            "limit",
-            "group",
-            "order",
-            "where",
-        ]:
+    for match in _SUBQUERY_RE.finditer(query_text):
+        depth = 1
+        for paren in _PAREN_RE.finditer(query_text, match.end()):
+            depth += 1 if paren.group() == '(' else -1
+            if depth == 0:
+                break
+        else:
+            # unbalanced parentheses, leave the rest of the query alone
+            break
+        pos = paren.end()
+        next_word = _NEXT_WORD_RE.match(query_text, pos).group(1)
+        if next_word[:1] in (')', ',') or next_word in _ALIAS_TRIGGERS:
             positions.append(pos)
-    for pos in sorted(positions, reverse=True):
-        query_text = query_text[:pos] + " as alias123 " + query_text[pos:]
-    return query_text
\ No newline at end of file
+
+    parts = []
+    last = 0
+    for pos in sorted(positions):
+        parts.append(query_text[last:pos])
+        parts.append(' as alias123 ')
+        last = pos
+    parts.append(query_text[last:])
+    return ''.join(parts)
@@ -1,70 +1,208 @@
 import logging
+import re
 import time
-from multiprocessing import Queue
-from connection import Connection
+from array import array
+from collections import Counter
+from datetime import timedelta
+from connection import AsyncConnection
 from replica import Replica
 
+# a statement is a run of anything but a semicolon, treating single-quoted
+# literals (which may themselves contain semicolons) as opaque
+_STATEMENT_RE = re.compile(r"(?:[^;']|'[^']*')+")
+
+def _split_statements(query: str) -> list[tuple[bool, str]]:
+    '''
+    Split a query into its individual SQL statements for EXPLAIN ANALYZE.
+
+    :param query: the (possibly multi-statement) query text
+    :returns: a list of (explain, statement) pairs, where `explain` is True if
+        the statement is a SELECT to be explained and False if it is view DDL
+        that must simply be executed. Any other statements are dropped
+    '''
+    statements = []
+    for statement in _STATEMENT_RE.findall(query):
+        if 'create view' in statement or 'drop view' in statement:
+            statements.append((False, statement))
+        elif 'select' in statement:
+            statements.append((True, statement))
+    return statements
+
+def _is_single_statement(query: str) -> bool:
+    '''
+    Does the query consist of exactly one SQL statement?
+    '''
+    return len([s for s in _STATEMENT_RE.findall(query) if s.strip()]) == 1
+
+_MICROSECOND = timedelta(microseconds=1)
+
 class QuerySet:
     def __init__(self, num: int, queries: list[str], templates: list[int],
-                 replica: Replica, timer_queue: Queue, explain_plans: bool):
+                 replica: Replica, explain_plans: bool,
+                 prepare_statements: bool = False, pipeline: bool = False):
         '''
-        Runs a set of queries on a single replica. Puts the amount of time
-        each query execution takes in the provided timer queue.
+        Runs a set of queries on a single replica, asynchronously, so that
+        the query sets for every replica can run concurrently in one event loop.
+        Returns the amount of time each query execution takes, in nanoseconds.
 
         :param num: which replica is this?
         :param queries: the list of queries to be executed on this node
         :param templates: which query is which, for logging purposes
         :param replica: the replica object this query set is to be executed on
-        :param timer_queue: the queue to pass execution times back to the main process
-        :param explain_plans: should we EXPLAIN ANALYZE each query?
+        :param explain_plans: should we EXPLAIN ANALYZE each query? if so, the
+            execution time reported by the server is used instead of the wall clock
+        :param prepare_statements: should single-statement queries whose text appears more than
+            once be executed as server-side prepared statements, so they are only planned once?
+        :param pipeline: should the queries be submitted in psycopg's pipeline mode, without
+            waiting for each to complete? the server's clock is then used to time each query.
+            ignored if `explain_plans` is set
         '''
         self.num = num
         self.queries = queries
         self.n_queries = len(queries)
         self.templates = templates
-        self.connection = Connection(replica)
-        self.cursor = self.connection.conn().cursor()
-        self.timer_queue = timer_queue
+        self.connection = AsyncConnection(replica)
+        self.cursor = None
         self.explain_plans = explain_plans
-    
-    def run(self):
+        self.statements = [_split_statements(q) for q in queries] if explain_plans else None
+        # multi-statement queries (ie, those that create views) can't be prepared,
+        # or have their results returned in binary, as both need the extended protocol.
+        # only text that repeats is worth preparing: for a query run once, it just adds a
+        # round trip to its timing. None leaves psycopg's default behaviour in place
+        self.binary = [_is_single_statement(q) for q in queries]
+        counts = Counter(queries)
+        self.prepare = [True if prepare_statements and single and counts[q] > 1 else None
+                        for q, single in zip(queries, self.binary)]
+        # psycopg's cache has to hold every repeated query, or they evict each other
+        self.n_prepared = len({q for q, p in zip(queries, self.prepare) if p})
+        self.pipeline = pipeline and not explain_plans
+
+    async def connect(self):
+        '''
+        Open the connection to the replica, ready for `arun`.
+        '''
+        await self.connection.connect()
+        conn = self.connection.conn()
+        # psycopg owns the prepared statements, so it prepares them again should the
+        # server discard them (eg, after Q15 drops its view)
+        if conn.prepared_max is not None and conn.prepared_max < self.n_prepared:
+            conn.prepared_max = self.n_prepared
+        self.cursor = conn.cursor()
+
+    async def arun(self) -> tuple[array, list[str] | None]:
         '''
         Run the queries and measure how long they take to execute.
+        `connect` must have been awaited first.
+
+        :returns times: how long each query took to execute, in nanoseconds
+        :returns plans: the plan of each query, if `explain_plans` is set
         '''
-        times = []
-        plans = []
-        total_tic = time.time()
+        cur = self.cursor
+        execute = cur.execute
+        times = array('q', [0] * self.n_queries)
+        templates = self.templates
+        statements = self.statements
+        prepare = self.prepare
+        binary = self.binary
+        num = self.num
+        n_queries = self.n_queries
+        debug = logging.debug
+        log_debug = logging.getLogger().isEnabledFor(logging.DEBUG)
+        now = time.perf_counter_ns
+        plans = [''] * n_queries if self.explain_plans else None
+        total_tic = now()
 
-        for i, query in enumerate(self.queries):
-            logging.debug(f'R{self.num}: execute {i + 1}/{self.n_queries}: Q{self.templates[i] + 1}')
+        if self.pipeline:
+            await self._run_pipelined(times)
+        elif self.explain_plans:
+            for i in range(n_queries):
+                if log_debug:
+                    debug('R%d: execute %d/%d: Q%d', num, i + 1, n_queries, templates[i] + 1)
 
-            tic = time.time()
-            if self.explain_plans:
+                # use the server-side execution time reported in the plan so
+                # that network and client overheads are not counted
                 plan = ''
-                for statement in query.split(';'):
-                    if 'create view' in statement or 'drop view' in statement:
-                        self.cursor.execute(statement)
-                    elif 'select' in statement:
-                        self.cursor.execute('EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) %s' % statement)
-                        plan += str(self.cursor.fetchone()[0][0])
-                plans.append(plan)
-            else:
-                self.cursor.execute(query)
-            toc = time.time()
-
-            logging.debug(f'R{self.num}:Q{self.templates[i] + 1}: {round(toc - tic, 2)}s')
-
-            times.append(toc - tic)
+                execution_time = 0.0
+                for explain, statement in statements[i]:
+                    if explain:
+                        await execute('EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) %s' % statement, binary=True)
+                        result = (await cur.fetchone())[0][0]
+                        execution_time += result['Execution Time']
+                        plan += str(result)
+                    else:
+                        await execute(statement)
+                plans[i] = plan
+                times[i] = int(execution_time * 1_000_000)
+
+                if log_debug:
+                    debug('R%d:Q%d: %.2fs', num, templates[i] + 1, times[i] / 1e9)
+        else:
+            for i, query in enumerate(self.queries):
+                if log_debug:
+                    debug('R%d: execute %d/%d: Q%d', num, i + 1, n_queries, templates[i] + 1)
+
+                tic = now()
+                await execute(query, prepare=prepare[i], binary=binary[i])
+                toc = now()
+                times[i] = toc - tic
+
+                if log_debug:
+                    debug('R%d:Q%d: %.2fs', num, templates[i] + 1, times[i] / 1e9)
         
-        total_toc = time.time()
+        total_toc = now()
+        total = (total_toc - total_tic) / 1e9
+
+        logging.info('replica %d completed in %.2fs', self.num, total)
+
+        await self.cursor.close()
+        await self.connection.close()
+
+        return times, plans
+
+    async def _run_pipelined(self, times: array):
+        '''
+        Submit the queries to the server in pipeline mode, without waiting
+        for each one's results before sending the next. The client can no
+        longer bracket each query with its own clock, so a `clock_timestamp()`
+        is read on the server either side of it.
+
+        Each query is followed by a Sync, so that it runs in its own
+        transaction as it would outside a pipeline: otherwise the whole
+        workload would be one implicit transaction, and one failing query
+        would abort every query after it. As psycopg may wait for results
+        when syncing, both of a query's timestamps are sent with it, so that
+        any wait is not counted against the query.
+        '''
+        conn = self.connection.conn()
+        execute = self.cursor.execute
+        templates = self.templates
+        prepare = self.prepare
+        num = self.num
+        n_queries = self.n_queries
+        debug = logging.debug
+        log_debug = logging.getLogger().isEnabledFor(logging.DEBUG)
+        stamps = []
+
+        async def stamp():
+            cur = conn.cursor()
+            await cur.execute('SELECT clock_timestamp()', binary=True)
+            stamps.append(cur)
 
-        self.timer_queue.put({
-            'total': total_toc - total_tic,
-            'times': times,
-            'plans': plans
-        })
+        async with conn.pipeline() as pipeline:
+            for i, query in enumerate(self.queries):
+                if log_debug:
+                    debug('R%d: submit %d/%d: Q%d', num, i + 1, n_queries, templates[i] + 1)
+                await stamp()
+                # the extended query protocol only allows one statement per execute
+                for statement in _STATEMENT_RE.findall(query):
+                    if statement.strip():
+                        await execute(statement, prepare=prepare[i], binary=True)
+                await stamp()
+                await pipeline.sync()
 
-        logging.info(f'replica {self.num} completed in {round(total_toc - total_tic, 2)}s')
+        stamps = [(await cur.fetchone())[0] for cur in stamps]
 
-        self.cursor.close()
-        self.connection.close()
+        for i in range(n_queries):
+            times[i] = (stamps[2 * i + 1] - stamps[2 * i]) // _MICROSECOND * 1000
+            if log_debug:
+                debug('R%d:Q%d: %.2fs', num, templates[i] + 1, times[i] / 1e9)
@@ -4,6 +4,7 @@ import os
 import shutil
 
 from benchmark import Benchmark
+from generator import KEY_WORKERS
 from replica import Replica
 from tpch_generator import TPCHGenerator
 from tpcds_generator import TPCDSGenerator
@@ -25,6 +26,12 @@ def create_arguments():
     parser.add_argument('-n', '--no-create-indexes', action='store_true', help='do not create the indexes (ie, if they are already present)')
     parser.add_argument('-x', '--destroy-indexes', action='store_true', help='destroy the indexes after the benchmarking concludes')
     parser.add_argument('-E', '--explain-query-plans', action='store_true', help='write query plans (EXPLAIN ANALYZE) to disk when running queries')
+    parser.add_argument('-P', '--prepare-statements', action='store_true', help='execute repeated single-statement queries as server-side prepared statements')
+    parser.add_argument('--pipeline', action='store_true', help='submit queries in pipeline mode, each in its own transaction, and time them with the server clock (not used with -E)')
+    parser.add_argument('--shuffle-seed', type=int, default=None, help='seed for the order queries are run in, for reproducible runs')
+    parser.add_argument('--stream-tables', action='store_true', help='TPC-H only: pipe dbgen output straight into the database when loading, instead of writing table files')
+    parser.add_argument('--unlogged-tables', action='store_true', help='create the tables UNLOGGED for a faster load (they are emptied if the server crashes)')
+    parser.add_argument('--key-workers', type=int, default=KEY_WORKERS, help='connections per replica building primary keys at once (they share 2GB of maintenance_work_mem)')
     parser.add_argument('--copy-source', type=str, default='/proj/qdina-PG0/dina-set/h/train', help='where the test set is stored')
     
     parser.add_argument('benchmark', choices=['h', 'ds', 'c'], help='which TPC benchmark should be run? TPC-[H] or TPC-[DS]?')
@@ -188,6 +195,12 @@ if __name__ == '__main__':
     CREATE_INDEXES = not args.no_create_indexes
     DESTROY_INDEXES = args.destroy_indexes
     EXPLAIN_PLANS = args.explain_query_plans
+    PREPARE_STATEMENTS = args.prepare_statements
+    PIPELINE = args.pipeline
+    SHUFFLE_SEED = args.shuffle_seed
+
+    if PIPELINE and EXPLAIN_PLANS:
+        logging.warning('pipeline mode is not used when explaining query plans')
 
     if 'all' in args.phase:
         PHASES_TO_RUN = ['generate', 'load', 'run']
@@ -212,9 +225,11 @@ if __name__ == '__main__':
     plan_dir = os.path.normpath(plan_dir)
 
     if args.benchmark == 'h':
-        generator = TPCHGenerator(replicas, dbgen_dir, data_dir, args.scale_factor)
+        generator = TPCHGenerator(replicas, dbgen_dir, data_dir, args.scale_factor, args.stream_tables, args.unlogged_tables, args.key_workers)
     else:
-        generator = TPCDSGenerator(replicas, dbgen_dir, data_dir, args.scale_factor)
+        if args.stream_tables:
+            logging.warning(f'--stream-tables is only supported for TPC-H; loading TPC-{args.benchmark.upper()} from table files')
+        generator = TPCDSGenerator(replicas, dbgen_dir, data_dir, args.scale_factor, args.unlogged_tables, args.key_workers)
 
     args.benchmark = args.benchmark.upper()
 
@@ -232,10 +247,10 @@ if __name__ == '__main__':
 
     if 'run' in PHASES_TO_RUN:
         if COPY_TEST_SET:
-            queries, templates = load_test_set_queries(COPY_SOURCE)
+            queries, templates, n_templates = load_test_set_queries(COPY_SOURCE)
         else:
-            queries, templates = generator.read_data()
-        benchmark = Benchmark(queries, templates, replicas, routes, config, CREATE_INDEXES, EXPLAIN_PLANS)
+            queries, templates, n_templates = generator.read_data()
+        benchmark = Benchmark(queries, templates, n_templates, replicas, routes, config, CREATE_INDEXES, EXPLAIN_PLANS, PREPARE_STATEMENTS, PIPELINE, SHUFFLE_SEED)
 
         total, times, plans = benchmark.run()
 
@@ -246,18 +261,21 @@ if __name__ == '__main__':
         if DESTROY_INDEXES:
             benchmark.destroy_indexes()
 
-        logging.info('=' * 30)
-        logging.info(f'TPC-{args.benchmark} Performance Benchmark Results')
-        logging.info('')
-        logging.info(f'Total Runtime                = {round(total, 3)}')
+        # build the whole report first so it is written to the log in one go
+        report = [
+            '=' * 30,
+            f'TPC-{args.benchmark} Performance Benchmark Results',
+            '',
+            f'Total Runtime                = {total:.3f}'
+        ]
         if len(partial_temps) > 0:
-            logging.info(f'Training Partition Runtime   = {round(partial, 3)}')
-        logging.info('')
-        for i, time in enumerate(times):
-            logging.info(f'Q{i + 1}                     = {round(time, 3)}')
-        logging.info('')
-        logging.info(f'Scale factor: {args.scale_factor}')
-        logging.info('=' * 30)
+            report.append(f'Training Partition Runtime   = {partial:.3f}')
+        report.append('')
+        report.extend(f'Q{i + 1}                     = {t:.3f}' for i, t in enumerate(times))
+        report.append('')
+        report.append(f'Scale factor: {args.scale_factor}')
+        report.append('=' * 30)
+        logging.info('\n'.join(report))
 
         if EXPLAIN_PLANS:
             # ensure directory exists
@@ -0,0 +1,52 @@
+import logging
+import os
+import subprocess
+
+OPTIMISATION_FLAGS = '-O3 -march=native -flto'
+
+def make_argv(cc: str = 'gcc') -> list[str]:
+    '''
+    The `make` invocation used to build the TPC toolkits: a parallel build
+    with optimisation and link-time optimisation enabled.
+
+    The flags are carried on CC rather than CFLAGS, as the vendor Makefiles
+    set their required -D defines in CFLAGS, and CC is also used to link.
+
+    :param cc: the C compiler to build with
+    :returns: the command to run in the toolkit directory
+    '''
+    return ['make', f'-j{os.cpu_count()}', f'CC={cc} {OPTIMISATION_FLAGS}']
+
+def run_checked(argv: list[str], cwd: str, env: dict | None = None, stdout=subprocess.PIPE) -> str | None:
+    '''
+    Run a command to completion, with no input. If it fails, its error output
+    is logged and a `subprocess.CalledProcessError` raised, so that a failed
+    build or generation step can't go unnoticed until the load.
+
+    :param argv: the command to run
+    :param cwd: the working directory to run the command in
+    :param env: the environment to run the command with (the current one if None)
+    :param stdout: where to send the standard output (by default, it is returned)
+    :returns: the standard output of the command, unless it was redirected
+    '''
+    try:
+        result = subprocess.run(argv, cwd=cwd, env=env, stdin=subprocess.DEVNULL, stdout=stdout,
+                                stderr=subprocess.PIPE, text=True, check=True)
+    except subprocess.CalledProcessError as e:
+        logging.error(f'{argv[0]} exited with status {e.returncode}:\n{e.stderr}')
+        raise
+
+    return result.stdout
+
+def run_to_file(argv: list[str], out_path: str, cwd: str, env: dict | None = None):
+    '''
+    Run a command, writing its standard output to `out_path`. This is a
+    module-level function so that it can be dispatched to a `multiprocessing.Pool`.
+
+    :param argv: the command to run
+    :param out_path: the file to write the output to
+    :param cwd: the working directory to run the command in
+    :param env: the environment to run the command with (the current one if None)
+    '''
+    with open(out_path, 'w') as outfile:
+        run_checked(argv, cwd, env, stdout=outfile)
@@ -1,18 +1,42 @@
-import glob
 import os
-import subprocess
-import shutil
 import logging
 import random
+import re
 
+from multiprocessing import Pool
 from replica import Replica
-from connection import Connection
-from generator import Generator
+from generator import KEY_WORKERS, Generator
+from tools import make_argv, run_checked, run_to_file
 
-TABLE_BLOCK_SIZE = 5_120_000
+_CREATE_TABLE_RE = re.compile(r'create table (\w+)(.*?);', re.IGNORECASE | re.DOTALL)
+_PRIMARY_KEY_RE = re.compile(r',\s*primary key\s*\(([^)]*)\)', re.IGNORECASE)
+
+def _split_primary_keys(ddl: str) -> tuple[str, list[str]]:
+    '''
+    Removes the inline primary key constraints from the CREATE TABLE
+    statements in the TPC-DS schema.
+
+    :param ddl: the schema, as given in tpcds.sql
+    :returns ddl: the schema without any primary keys
+    :returns primary_keys: an ALTER TABLE statement to add each primary key back
+    '''
+    primary_keys = []
+
+    def strip(match: re.Match) -> str:
+        table, body = match.group(1), match.group(2)
+        for columns in _PRIMARY_KEY_RE.findall(body):
+            primary_keys.append(f'ALTER TABLE {table} ADD PRIMARY KEY ({columns.strip()});')
+        body = _PRIMARY_KEY_RE.sub('', body)
+        return f'create table {table}{body};'
+
+    return _CREATE_TABLE_RE.sub(strip, ddl), primary_keys
 
 class TPCDSGenerator(Generator):
-    def __init__(self, replicas: list[Replica], dbgen_path: str, data_path: str, scale_factor: int):
+    table_extension = '.dat'
+    copy_options = "(format csv, delimiter '|')"
+    n_templates = 99
+
+    def __init__(self, replicas: list[Replica], dbgen_path: str, data_path: str, scale_factor: int, unlogged_tables: bool = False, key_workers: int = KEY_WORKERS):
         '''
         TPC-DS data generator. Interface to the `dsdgen` tool provided by
         the Transaction Processing Performance Council.
@@ -30,6 +54,8 @@ class TPCDSGenerator(Generator):
         :param dbgen_path: the location of the directory where dbgen will be compiled (fully qualified)
         :param data_path: the desired data directory for the output table data/queries/refresh functions
         :param scale_factor: the TPC-DS scale factor (usually 1 for our experiments)
+        :param unlogged_tables: create the tables UNLOGGED, so loading them and building their keys skips the WAL (but they are emptied after a crash)
+        :param key_workers: how many connections to each replica build primary keys at once
         '''
         self.replicas = replicas
         self.dbgen_path = dbgen_path
@@ -37,6 +63,9 @@ class TPCDSGenerator(Generator):
         self.scale_factor = str(scale_factor)
         self.dbname = replicas[0].dbname
         self.root_dir = os.path.dirname(os.path.realpath(__file__))
+        self.unlogged_tables = unlogged_tables
+        self.key_workers = key_workers
+        self._queries = None
     
     def generate(self, rng_seed: int | None = None):
         '''
@@ -55,36 +84,15 @@ class TPCDSGenerator(Generator):
         self._compile_dsdgen()
         self._create_table_data(rng_seed)
         self._create_queries(rng_seed)
+        self._queries = None
 
-    def load_database(self):
-        '''
-        Loads the data into the database.
-
-        (1) Resets each database, creates the schemas, and loads the generated table data.
-
-        (2) Creates the default primary key/foreign key constraints on those tables.
-        '''
-        connections = [Connection(replica) for replica in self.replicas]
-        tables = []
-
-        for table_file in glob.glob(f'{self.data_path}/tables/*.dat'):
-            name = os.path.basename(table_file)
-            tables.append(name.split('.')[0])
-
-        self._reset_database(connections, tables)
-        self._create_schemas(connections)
-        self._load_table_data(connections)
-        self._create_keys(connections)
-
-        for c in connections:
-            c.close()
-
-    def read_data(self) -> tuple[list[str], list[int]]:
+    def read_data(self) -> tuple[list[str], list[int], int]:
         '''
         Loads the queries into memory.
 
         :returns queries: the 99 generated queries to be executed according to the stream order given in the specification
         :returns templates: the template number of each query
+        :returns n_templates: how many templates there are
         '''
         return self._load_queries()
     
@@ -96,80 +104,44 @@ class TPCDSGenerator(Generator):
 
     def _compile_dsdgen(self):
         logging.debug(f'attempting to compile TPC-DS dsdgen at {self.dbgen_path}')
-        subprocess.run(['make', 'CC="gcc-9"'], cwd=self.dbgen_path)
+        logging.debug(run_checked(make_argv('gcc-9'), self.dbgen_path))
     
     def _create_table_data(self, rng_seed: str):
         logging.debug(f'creating table data for scale factor {self.scale_factor}')
-        subprocess.run([f'{self.dbgen_path}/dsdgen',
-                        '-DIR', f'{self.data_path}/tables',
-                        '-SCALE', self.scale_factor,
-                        '-TERMINATE', 'N',
-                        '-RNGSEED', rng_seed
-                        ], cwd=self.dbgen_path)
-
-        shutil.copy(f'{self.dbgen_path}/tpcds.sql', f'{self.data_path}/schema/dss.ddl')
-        shutil.copy(f'{self.dbgen_path}/tpcds_ri.sql', f'{self.data_path}/schema/schema_keys.sql')
+        run_checked([f'{self.dbgen_path}/dsdgen',
+                     '-DIR', f'{self.data_path}/tables',
+                     '-SCALE', self.scale_factor,
+                     '-TERMINATE', 'N',
+                     '-RNGSEED', rng_seed
+                     ], self.dbgen_path)
+
+        # the primary keys are declared inline in tpcds.sql; move them into
+        # schema_keys.sql, ahead of the foreign keys that reference them, so
+        # that the indexes are built after the data is loaded, not during
+        with open(f'{self.dbgen_path}/tpcds.sql', 'r') as infile:
+            ddl, primary_keys = _split_primary_keys(infile.read())
+        with open(f'{self.dbgen_path}/tpcds_ri.sql', 'r') as infile:
+            foreign_keys = infile.read()
+
+        with open(f'{self.data_path}/schema/dss.ddl', 'w') as outfile:
+            outfile.write(ddl)
+        with open(f'{self.data_path}/schema/schema_keys.sql', 'w') as outfile:
+            outfile.write('\n'.join(primary_keys) + '\n\n' + foreign_keys)
 
     def _create_queries(self, rng_seed: str):
         logging.debug(f'creating TPC-DS query data')
 
-        for i in range(1, 99 + 1):
-            with open(f'{self.data_path}/queries/{i}.sql', 'w') as outfile:
-                subprocess.run([f'{self.dbgen_path}/dsqgen',
-                                '-SCALE', self.scale_factor,
-                                '-RNGSEED', rng_seed,
-                                '-TEMPLATE', f'query{i}.tpl',
-                                '-DIALECT', 'netezza',
-                                '-DIRECTORY', os.path.normpath(os.path.join(self.dbgen_path, '..', 'query_templates')),
-                                '-FILTER', 'Y'],
-                               cwd=self.dbgen_path,
-                               stdout=outfile)
-    
-    def _reset_database(self, connections: list[Connection], tables: list[str]):
-        '''
-        Drops the tables specified.
+        template_dir = os.path.normpath(os.path.join(self.dbgen_path, '..', 'query_templates'))
+        base_argv = [f'{self.dbgen_path}/dsqgen',
+                     '-SCALE', self.scale_factor,
+                     '-RNGSEED', rng_seed,
+                     '-DIALECT', 'netezza',
+                     '-DIRECTORY', template_dir,
+                     '-FILTER', 'Y']
 
-        :param tables: a list of table names
-        '''
-        logging.debug(f'dropping existing tables: {tables}')
-        for c in connections:
-            with c.conn().cursor() as cur:
-                for table in tables:
-                    cur.execute(f'DROP TABLE IF EXISTS {table} CASCADE')
-
-    def _create_schemas(self, connections: list[Connection]):
-        logging.info('creating the schemas for tables')
-        for c in connections:
-            with c.conn().cursor() as cur:
-                with open(f'{self.data_path}/schema/dss.ddl', 'r') as infile:
-                    cur.execute(infile.read())
-
-    def _create_keys(self, connections: list[Connection]):
-        logging.info('creating primary and foreign keys')
-        for c in connections:
-            with c.conn().cursor() as cur:
-                with open(f'{self.data_path}/schema/schema_keys.sql', 'r') as infile:
-                    cur.execute(infile.read())
-    
-    def _load_table_data(self, connections: list[Connection]):
-        for table_file in glob.glob(f'{self.data_path}/tables/*.dat'):
-            table = os.path.basename(table_file).split('.')[0]
-            logging.info(f'loading data into {table}')
-            for num, c in enumerate(connections):
-                logging.debug(f'loading to replica {num}')
-                with c.conn().cursor() as cur:
-                    with cur.copy(f'COPY {table} FROM STDIN (format csv, delimiter \'|\')') as copy:
-                        with open(table_file, 'r') as input:
-                            while data := input.read(TABLE_BLOCK_SIZE):
-                                copy.write(data)
-
-    def _load_queries(self) -> tuple[list[str], list[int]]:
-        logging.info('reading queries')
-        queries = []
-        templates = list(range(99))
-
-        for i in range(1, 99 + 1):
-            with open(f'{self.data_path}/queries/{i}.sql', 'r') as infile:
-                queries.append(infile.read())
-        
-        return queries, templates
+        jobs = [(base_argv + ['-TEMPLATE', f'query{i}.tpl'],
+                 f'{self.data_path}/queries/{i}.sql',
+                 self.dbgen_path) for i in range(1, self.n_templates + 1)]
+
+        with Pool(os.cpu_count()) as pool:
+            pool.starmap(run_to_file, jobs)
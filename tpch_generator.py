@@ -4,15 +4,77 @@ import subprocess
 import shutil
 import logging
 import random
+import tempfile
+import threading
 
+from contextlib import contextmanager
+from multiprocessing import Pool
 from replica import Replica
 from connection import Connection
-from generator import Generator
-
-TABLE_BLOCK_SIZE = 5_120_000
+from generator import KEY_WORKERS, TABLE_BLOCK_SIZE, Generator
+from tools import make_argv, run_checked, run_to_file
+
+# the dbgen -T code that generates each table, and only that table
+TABLE_CODES = {
+    'customer': 'c',
+    'lineitem': 'L',
+    'nation': 'n',
+    'orders': 'O',
+    'part': 'P',
+    'partsupp': 'S',
+    'region': 'r',
+    'supplier': 's',
+}
+
+def _strip_trailing_delimiters(input):
+    '''
+    The table data by default includes a trailing pipe (|) character on
+    each row that must be removed for Postgres to process it correctly with
+    the `COPY FROM` command. Rather than rewriting the file, this strips
+    them from each block as it is streamed to the database.
+
+    :param input: the table file, opened in binary mode
+    :returns: an iterator over the corrected blocks of table data
+    '''
+    pending = b''
+    while data := input.read(TABLE_BLOCK_SIZE):
+        if pending:
+            data = pending + data
+        # hold back a trailing pipe, in case its newline is in the next block
+        if data.endswith(b'|'):
+            data, pending = data[:-1], b'|'
+        else:
+            pending = b''
+        yield data.replace(b'|\n', b'\n')
+
+def _release_fifo(proc: subprocess.Popen, fifo: str, opened: threading.Event):
+    '''
+    Wait for dbgen to exit. If it exited (for whatever reason) without opening
+    the FIFO for writing, the reader would block in `open()` forever, so open
+    and close the write end until the reader's `open()` has returned. The
+    reader then sees EOF.
+
+    :param proc: the dbgen process writing to the FIFO
+    :param fifo: the path of the FIFO
+    :param opened: set by the reader once its `open()` has returned
+    '''
+    proc.wait()
+    while not opened.is_set():
+        try:
+            os.close(os.open(fifo, os.O_WRONLY | os.O_NONBLOCK))
+            return
+        except OSError:
+            # ENXIO: the reader hasn't reached open() yet
+            opened.wait(0.01)
 
 class TPCHGenerator(Generator):
-    def __init__(self, replicas: list[Replica], dbgen_path: str, data_path: str, scale_factor: int):
+    table_extension = '.tbl'
+    # dbgen never emits quotes or backslashes, so the cheaper text format
+    # parser reads the data the same way the CSV parser would
+    copy_options = "(format text, delimiter '|', null '')"
+    n_templates = 22
+
+    def __init__(self, replicas: list[Replica], dbgen_path: str, data_path: str, scale_factor: int, stream_tables: bool = False, unlogged_tables: bool = False, key_workers: int = KEY_WORKERS):
         '''
         TPC-H data generator. Interface to the `dbgen` tool provided by
         the Transaction Processing Performance Council.
@@ -30,6 +92,9 @@ class TPCHGenerator(Generator):
         :param dbgen_path: the location of the directory where dbgen will be compiled (fully qualified)
         :param data_path: the desired data directory for the output table data/queries/refresh functions
         :param scale_factor: the TPC-H scale factor (usually 10 for our experiments)
+        :param stream_tables: rather than writing the table data to disk when generating, run dbgen per replica when loading and stream its output into the database
+        :param unlogged_tables: create the tables UNLOGGED, so loading them and building their keys skips the WAL (but they are emptied after a crash)
+        :param key_workers: how many connections to each replica build primary keys at once
         '''
         self.replicas = replicas
         self.dbgen_path = dbgen_path
@@ -37,6 +102,10 @@ class TPCHGenerator(Generator):
         self.scale_factor = str(scale_factor)
         self.dbname = replicas[0].dbname
         self.root_dir = os.path.dirname(os.path.realpath(__file__))
+        self.unlogged_tables = unlogged_tables
+        self.key_workers = key_workers
+        self.stream_tables = stream_tables
+        self._queries = None
     
     def generate(self, rng_seed: int | None = None):
         '''
@@ -54,39 +123,19 @@ class TPCHGenerator(Generator):
         self._create_directories()
         self._move_query_templates()
         self._compile_dbgen()
-        self._create_table_data()
-        self._format_table_data()
+        if not self.stream_tables:
+            self._create_table_data()
+        self._copy_schemas()
         self._create_queries()
+        self._queries = None
 
-    def load_database(self):
-        '''
-        Loads the data into the database.
-
-        (1) Resets each database, creates the schemas, and loads the generated table data.
-
-        (2) Creates the default primary key/foreign key constraints on those tables.
-        '''
-        connections = [Connection(replica) for replica in self.replicas]
-        tables = []
-
-        for table_file in glob.glob(f'{self.data_path}/tables/*.tbl'):
-            name = os.path.basename(table_file)
-            tables.append(name.split('.')[0])
-
-        self._reset_database(connections, tables)
-        self._create_schemas(connections)
-        self._load_table_data(connections)
-        self._create_keys(connections)
-
-        for c in connections:
-            c.close()
-
-    def read_data(self) -> tuple[list[str], list[int]]:
+    def read_data(self) -> tuple[list[str], list[int], int]:
         '''
         Loads the queries into memory.
 
         :returns queries: the 22 generated queries to be executed according to the stream order given in the specification
         :returns templates: the template number of each query
+        :returns n_templates: how many templates there are
         '''
         return self._load_queries()
     
@@ -99,17 +148,18 @@ class TPCHGenerator(Generator):
 
     def _compile_dbgen(self):
         logging.debug(f'attempting to compile TPC-H dbgen at {self.dbgen_path}')
-        subprocess.run('make', cwd=self.dbgen_path)
+        logging.debug(run_checked(make_argv(), self.dbgen_path))
     
     def _create_table_data(self):
         logging.debug(f'creating table data for scale factor {self.scale_factor}')
-        subprocess.run([f'{self.dbgen_path}/dbgen', '-s', self.scale_factor, '-vf'], cwd=self.dbgen_path)
+        run_checked([f'{self.dbgen_path}/dbgen', '-s', self.scale_factor, '-vf'], self.dbgen_path)
 
         table_paths = glob.glob('*.tbl', root_dir=self.dbgen_path)
 
         for file in table_paths:
             shutil.move(f'{self.dbgen_path}/{file}', f'{self.data_path}/tables/{os.path.basename(file)}')
 
+    def _copy_schemas(self):
         shutil.copy(f'{self.dbgen_path}/dss.ddl', f'{self.data_path}/schema/dss.ddl')
         shutil.copy(f'{self.root_dir}/schema_keys.sql', f'{self.data_path}/schema/schema_keys.sql')
     
@@ -126,69 +176,63 @@ class TPCHGenerator(Generator):
     def _create_queries(self):
         logging.debug(f'creating TPC-H query data')
 
-        for i in range(1, 23):
-            with open(f'{self.data_path}/queries/{i}.sql', 'w') as outfile:
-                subprocess.run([f'{self.dbgen_path}/qgen', '-s', self.scale_factor, str(i)],
-                               cwd=self.dbgen_path,
-                               env=dict(os.environ, DSS_QUERY=f'{self.dbgen_path}/queries'),
-                               stdout=outfile)
+        env = dict(os.environ, DSS_QUERY=f'{self.dbgen_path}/queries')
+        jobs = [([f'{self.dbgen_path}/qgen', '-s', self.scale_factor, str(i)],
+                 f'{self.data_path}/queries/{i}.sql',
+                 self.dbgen_path,
+                 env) for i in range(1, self.n_templates + 1)]
+
+        with Pool(os.cpu_count()) as pool:
+            pool.starmap(run_to_file, jobs)
     
-    def _reset_database(self, connections: list[Connection], tables: list[str]):
-        '''
-        Drops the tables specified.
+    def _tables(self) -> list[str]:
+        if self.stream_tables:
+            return list(TABLE_CODES)
+        return super()._tables()
 
-        :param tables: a list of table names
+    def _load_table_data(self, connections: list[Connection]):
+        if self.stream_tables:
+            self._foreach_conn(connections, self._stream_replica)
+        else:
+            super()._load_table_data(connections)
+
+    def _stream_replica(self, connection: Connection):
         '''
-        logging.debug(f'dropping existing tables: {tables}')
-        for c in connections:
-            with c.conn().cursor() as cur:
-                for table in tables:
-                    cur.execute(f'DROP TABLE IF EXISTS {table} CASCADE')
-
-    def _create_schemas(self, connections: list[Connection]):
-        logging.info('creating the schemas for tables')
-        for c in connections:
-            with c.conn().cursor() as cur:
-                with open(f'{self.data_path}/schema/dss.ddl', 'r') as infile:
-                    cur.execute(infile.read())
-
-    def _create_keys(self, connections: list[Connection]):
-        logging.info('creating primary and foreign keys')
-        for c in connections:
-            with c.conn().cursor() as cur:
-                with open(f'{self.data_path}/schema/schema_keys.sql', 'r') as infile:
-                    cur.execute(infile.read())
-    
-    def _format_table_data(self):
+        Loads the table data into a replica straight from dbgen, one table at a
+        time. dbgen writes each table into a FIFO in a private directory
+        (DSS_PATH), so the rows never touch the disk.
         '''
-        The table data by default includes a trailing pipe (|) character
-        that must be removed for Postgres to process it correctly with the
-        `COPY FROM ... FORMAT CSV` command. We do that in-place here.
+        self._prepare_load_session(connection)
+        with tempfile.TemporaryDirectory() as fifo_dir:
+            env = dict(os.environ, DSS_PATH=fifo_dir)
+            for table, code in TABLE_CODES.items():
+                logging.info(f'streaming data into {table} on replica {connection.replica.id}')
+                with self._copy_into(connection, table) as copy, self._generate_table(table, code, fifo_dir, env) as input:
+                    self._write_table(copy, input)
+
+    @contextmanager
+    def _generate_table(self, table: str, code: str, fifo_dir: str, env: dict):
         '''
-        logging.info('correcting table data CSV format for postgres...')
-        for table_file in glob.glob(f'*.tbl', root_dir=f'{self.data_path}/tables'):
-            logging.debug(table_file)
-            subprocess.run(['sed', '-i', 's/.$//', table_file], cwd=f'{self.data_path}/tables')
-    
-    def _load_table_data(self, connections: list[Connection]):
-        for table_file in glob.glob(f'{self.data_path}/tables/*.tbl'):
-            table = os.path.basename(table_file).split('.')[0]
-            logging.info(f'loading data into {table}')
-            for num, c in enumerate(connections):
-                logging.debug(f'loading to replica {num}')
-                with c.conn().cursor() as cur:
-                    with cur.copy(f'COPY {table} FROM STDIN (format csv, delimiter \'|\')') as copy:
-                        with open(table_file, 'r') as input:
-                            while data := input.read(TABLE_BLOCK_SIZE):
-                                copy.write(data)
-
-    def _load_queries(self) -> tuple[list[str], list[int]]:
-        logging.info('reading queries')
-        queries = []
-        templates = list(range(22))
-
-        for i in range(1, 23):
-            with open(f'{self.data_path}/queries/{i}.sql', 'r') as infile:
-                queries.append(infile.read())
-        
-        return queries, templates
+        Runs dbgen for a single table, opening the FIFO it writes the table to.
+        Raises once the FIFO is finished with if dbgen failed, so that the COPY
+        it was feeding is aborted.
+        '''
+        fifo = f'{fifo_dir}/{table}.tbl'
+        os.mkfifo(fifo)
+        proc = subprocess.Popen([f'{self.dbgen_path}/dbgen', '-s', self.scale_factor, '-f', '-T', code],
+                                cwd=self.dbgen_path, env=env, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
+        opened = threading.Event()
+        watcher = threading.Thread(target=_release_fifo, args=(proc, fifo, opened), daemon=True)
+        watcher.start()
+
+        with open(fifo, 'rb', buffering=0) as input:
+            opened.set()
+            yield input
+
+        watcher.join()
+        if proc.returncode != 0:
+            raise subprocess.CalledProcessError(proc.returncode, proc.args)
+
+    def _write_table(self, copy, input):
+        for data in _strip_trailing_delimiters(input):
+            copy.write(data)
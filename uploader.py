@@ -1,22 +1,24 @@
 import psycopg
-import glob
-import os
+import shutil
+
+from psycopg.copy import QueuedLibpqWriter
+from generator import TABLE_BLOCK_SIZE, list_tables, open_sequential
 
 CONNECTION_STRING = 'host=127.0.0.1 port=5432 dbname=tpchdb-3 user=sam'
-TABLE_BLOCK_SIZE = 5_120_000
 ROOT_DIR = '/Users/sam/Documents/Development/dina/tpc-h/dbgen'
 
 def upload_tables():
-    tables = glob.glob(f'{ROOT_DIR}/*.tbl')
+    tables = list_tables(ROOT_DIR, '.tbl')
+    # one connection (and, since autocommit is off, one transaction that is
+    # committed when the block exits) is shared by every table
     with psycopg.connect(CONNECTION_STRING) as conn:
         with conn.cursor() as cur:
-            for table_file in tables:
-                table = os.path.basename(table_file).split('.')[0]
+            for table, table_file in tables:
                 print(f'uploading to {table}')
-                with cur.copy(f'COPY {table} FROM STDIN (format csv, delimiter \'|\')') as copy:
-                    with open(table_file, 'r') as input:
-                        while data := input.read(TABLE_BLOCK_SIZE):
-                            copy.write(data)
+                with cur.copy(f'COPY {table} FROM STDIN (format csv, delimiter \'|\')',
+                              writer=QueuedLibpqWriter(cur)) as copy:
+                    with open_sequential(table_file) as input:
+                        shutil.copyfileobj(input, copy, length=TABLE_BLOCK_SIZE)
 
 if __name__ == '__main__':
     upload_tables()